@@ -1,7 +1,7 @@
 import logging
 from dataclasses import asdict, dataclass, field
 from pathlib import Path
-from typing import Dict, List
+from typing import Dict, List, Optional
 
 import trio
 import yaml
@@ -113,8 +113,10 @@ class ConfigGenerator:
 
     @staticmethod
     async def generate_config(
-        comma_separated_fastly_tokens: str, base_config: Config = default_config()
+        comma_separated_fastly_tokens: str, base_config: Optional[Config] = None
     ) -> Config:
+        if base_config is None:
+            base_config = default_config()
         fastly_tokens = comma_separated_fastly_tokens.split(",")
         fastly_tokens = list(map(lambda token: token.strip(), fastly_tokens))
         for token in fastly_tokens:
@@ -16,6 +16,10 @@ logger: logging.Logger = logging.getLogger("")
 
 
 ACL_CAPACITY = 100
+# Maximum number of requests in flight for a single fastly account token.
+MAX_CONCURRENT_REQUESTS = 32
+# Maximum number of entry operations fastly accepts in a single ACL batch update.
+ACL_BATCH_SIZE = 1000
 
 
 @dataclass
@@ -31,8 +35,23 @@ class ACL:
     created: bool = False
 
     def is_full(self) -> bool:
-        is_full = self.entry_count == ACL_CAPACITY
-        return is_full
+        # entry_count already accounts for staged additions and deletions.
+        return self.entry_count >= ACL_CAPACITY
+
+    @classmethod
+    def from_jsonable_dict(cls, jsonable_dict: Dict) -> "ACL":
+        # Positional arguments follow the field order, and skip building a kwargs dict per ACL.
+        return cls(
+            jsonable_dict["id"],
+            jsonable_dict["name"],
+            jsonable_dict["service_id"],
+            jsonable_dict["version"],
+            set(jsonable_dict["entries_to_add"]),
+            set(jsonable_dict["entries_to_delete"]),
+            jsonable_dict["entries"],
+            jsonable_dict["entry_count"],
+            jsonable_dict["created"],
+        )
 
     def as_jsonable_dict(self) -> Dict:
         return {
@@ -59,6 +78,10 @@ class VCL:
     dynamic: str = "1"
     id: str = ""
 
+    def __post_init__(self):
+        # Not a field, so it is neither serialized nor expected when loading from cache.
+        self.conditional_hash = hash(self.conditional)
+
     def as_jsonable_dict(self):
         return asdict(self)
 
@@ -77,20 +100,55 @@ class VCL:
         }
 
 
+def canonical_network(network: str) -> str:
+    """
+    Returns the normalized "address/prefixlen" form of the network, which is also how CrowdSec
+    decisions represent IPs and ranges. Keying ACL entries this way lets them be matched against
+    decisions with exact lookups.
+    """
+    return str(ipaddress.ip_network(network, strict=False))
+
+
 async def raise_on_4xx_5xx(response):
     response.raise_for_status()
 
 
+class ThrottledAsyncClient(httpx.AsyncClient):
+    """
+    AsyncClient which queues requests beyond "max_concurrent_requests" until a slot frees up. All
+    the services of an account share the client, so their bursts are smoothed out together.
+    """
+
+    def __init__(self, *args, max_concurrent_requests: int, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._limiter = trio.CapacityLimiter(max_concurrent_requests)
+
+    async def send(self, *args, **kwargs):
+        async with self._limiter:
+            return await super().send(*args, **kwargs)
+
+
 class FastlyAPI:
     base_url = "https://api.fastly.com"
 
     def __init__(self, token):
         self._token = token
         self._acl_count = 0
-        self.session = httpx.AsyncClient(
+        self.session = ThrottledAsyncClient(
+            max_concurrent_requests=MAX_CONCURRENT_REQUESTS,
             headers=httpx.Headers({"Fastly-Key": self._token}),
             timeout=httpx.Timeout(connect=30, read=None, write=15, pool=None),
-            transport=httpx.AsyncHTTPTransport(retries=3),
+            # Requests are multiplexed over a few long lived HTTP/2 connections, which are kept
+            # open across update ticks.
+            transport=httpx.AsyncHTTPTransport(
+                retries=3,
+                http2=True,
+                limits=httpx.Limits(
+                    max_connections=MAX_CONCURRENT_REQUESTS,
+                    max_keepalive_connections=MAX_CONCURRENT_REQUESTS,
+                    keepalive_expiry=60,
+                ),
+            ),
             event_hooks={"response": [raise_on_4xx_5xx]},
         )
 
@@ -279,12 +337,12 @@ class FastlyAPI:
         resp = resp.json()
         acl.entries = {}
         for entry in resp:
-            acl.entries[f"{entry['ip']}/{entry['subnet']}"] = entry["id"]
+            acl.entries[canonical_network(f"{entry['ip']}/{entry['subnet']}")] = entry["id"]
         return acl
 
     async def process_acl(self, acl: ACL):
-        logger.debug(with_suffix(f"entries to delete {acl.entries_to_delete}", acl_id=acl.id))
-        logger.debug(with_suffix(f"entries to add {acl.entries_to_add}", acl_id=acl.id))
+        logger.debug(with_suffix("entries to delete %s", acl.entries_to_delete, acl_id=acl.id))
+        logger.debug(with_suffix("entries to add %s", acl.entries_to_add, acl_id=acl.id))
         update_entries = []
         for entry_to_add in acl.entries_to_add:
             if entry_to_add in acl.entries:
@@ -292,6 +350,7 @@ class FastlyAPI:
             network = ipaddress.ip_network(entry_to_add)
             ip, subnet = str(network.network_address), network.prefixlen
             update_entries.append({"op": "create", "ip": ip, "subnet": subnet})
+        has_creates = bool(update_entries)
 
         for entry_to_delete in acl.entries_to_delete:
             update_entries.append(
@@ -304,18 +363,30 @@ class FastlyAPI:
         if not update_entries:
             return
 
-        # Only 100 operations per request can be done on an acl.
-        async with trio.open_nursery() as n:
-            for i in range(0, len(update_entries), 100):
-                update_entries_batch = update_entries[i : i + 100]
-                request_body = {"entries": update_entries_batch}
-                f = partial(self.session.patch, json=request_body)
-                n.start_soon(
-                    f,
-                    self.api_url(f"/service/{acl.service_id}/acl/{acl.id}/entries"),
-                )
-
-        acl = await self.refresh_acl_entries(acl)
+        # Replacing every entry of an ACL takes at most 2 * ACL_CAPACITY operations, so this is a
+        # single request in practice, which is sent without a nursery.
+        entries_url = self.api_url(f"/service/{acl.service_id}/acl/{acl.id}/entries")
+        if len(update_entries) <= ACL_BATCH_SIZE:
+            await self.session.patch(entries_url, json={"entries": update_entries})
+        else:
+            async with trio.open_nursery() as n:
+                for i in range(0, len(update_entries), ACL_BATCH_SIZE):
+                    update_entries_batch = update_entries[i : i + ACL_BATCH_SIZE]
+                    request_body = {"entries": update_entries_batch}
+                    f = partial(self.session.patch, json=request_body)
+                    n.start_soon(f, entries_url)
+
+        # Fastly only assigns ids to new entries, so a refresh is needed only when entries were
+        # created. Deleted entries are dropped locally. acl.entries is rebound instead of mutated
+        # since previously serialized states may still reference it.
+        if has_creates:
+            acl = await self.refresh_acl_entries(acl)
+        else:
+            acl.entries = {
+                entry: entry_id
+                for entry, entry_id in acl.entries.items()
+                if entry not in acl.entries_to_delete
+            }
 
     @staticmethod
     def api_url(endpoint: str) -> str:
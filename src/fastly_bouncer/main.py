@@ -1,5 +1,4 @@
 import argparse
-import json
 import logging
 import signal
 import sys
@@ -8,6 +7,7 @@ from math import ceil
 from pathlib import Path
 from typing import List
 
+import orjson
 import trio
 from pycrowdsec.client import StreamClient
 
@@ -193,8 +193,12 @@ async def setup_fastly_infra(config: Config, cleanup_mode):
             if not s:
                 logger.warning(f"cache file at {config.cache_path} is empty")
             else:
-                cache = json.loads(s)
-                services = list(map(Service.from_jsonable_dict, cache["service_states"]))
+                cache = orjson.loads(s)
+                api_by_token = {}
+                services = [
+                    Service.from_jsonable_dict(service_state, api_by_token)
+                    for service_state in cache["service_states"]
+                ]
                 logger.info(f"loaded exisitng infra using cache")
                 if not cleanup_mode:
                     return services
@@ -255,12 +259,12 @@ async def run(config: Config, services: List[Service]):
             for s in services:
                 n.start_soon(s.transform_state, new_state)
 
-        new_states = list(map(lambda service: service.as_jsonable_dict(), services))
+        new_states = [service.as_jsonable_dict() for service in services]
         if new_states != previous_states:
             logger.debug("updating cache")
             new_cache = {"service_states": new_states, "bouncer_version": VERSION}
-            async with await trio.open_file(config.cache_path, "w") as f:
-                await f.write(json.dumps(new_cache, indent=4))
+            async with await trio.open_file(config.cache_path, "wb") as f:
+                await f.write(orjson.dumps(new_cache, option=orjson.OPT_INDENT_2))
             logger.debug("done updating cache")
             previous_states = new_states
 
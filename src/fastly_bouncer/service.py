@@ -1,7 +1,8 @@
+import heapq
 import logging
 import uuid
 from dataclasses import dataclass, field
-from typing import Dict, Iterable, List, Set
+from typing import Dict, Iterable, List, Optional, Set, Tuple
 
 import trio
 
@@ -11,6 +12,9 @@ from fastly_bouncer.utils import with_suffix
 
 logger: logging.Logger = logging.getLogger("")
 
+# Maximum number of ACLs being created at once for a collection.
+MAX_CONCURRENT_ACL_CREATIONS = 8
+
 
 class ACLCollection:
     """
@@ -24,85 +28,132 @@ class ACLCollection:
         service_id: str,
         version: str,
         action: str,
-        acls=[],
-        state=set(),
+        acls: Optional[List[ACL]] = None,
+        state: Optional[Set] = None,
     ):
-        self.acls: List[ACL] = acls
         self.api: FastlyAPI = api
         self.service_id = service_id
         self.version = version
         self.action = action
-        self.state: Set = state
+        self.state: Set = state if state is not None else set()
+        self.acls: List[ACL] = acls if acls is not None else []
+
+    @property
+    def acls(self) -> List[ACL]:
+        return self._acls
+
+    @acls.setter
+    def acls(self, acls: List[ACL]):
+        self._acls = acls
+        self._jsonable_dict: Optional[Dict] = None
+        self._rebuild_entry_index()
+
+    def _rebuild_entry_index(self):
+        """
+        Rebuilds the item->ACL index used to locate the ACL holding any item without scanning
+        every ACL, the heap of ACLs which are not full, and the ACLs with uncommitted changes.
+        """
+        self._entry_to_acl: Dict[str, ACL] = {}
+        self._position_by_acl_name: Dict[str, int] = {}
+        # Heap of positions in self.acls, so that items keep filling the first ACLs first.
+        self._nonfull_acls: List[int] = []
+        self._dirty_acls: Dict[str, ACL] = {}
+        for i, acl in enumerate(self._acls):
+            self._position_by_acl_name[acl.name] = i
+            if not acl.is_full():
+                self._nonfull_acls.append(i)
+            if acl.entries_to_add or acl.entries_to_delete:
+                self._dirty_acls[acl.name] = acl
+            entries = acl.entries
+            if acl.entries_to_delete:
+                entries = entries.keys() - acl.entries_to_delete
+            self._entry_to_acl.update(dict.fromkeys(entries, acl))
+            self._entry_to_acl.update(dict.fromkeys(acl.entries_to_add, acl))
 
     def as_jsonable_dict(self) -> Dict:
-        return {
-            "acls": list(map(lambda acl: acl.as_jsonable_dict(), self.acls)),
-            "token": self.api._token,
-            "service_id": self.service_id,
-            "version": self.version,
-            "action": self.action,
-            "state": list(self.state),
-        }
+        # The serialized collection is reused until the collection is modified.
+        if self._jsonable_dict is None:
+            self._jsonable_dict = {
+                "acls": [acl.as_jsonable_dict() for acl in self.acls],
+                "token": self.api._token,
+                "service_id": self.service_id,
+                "version": self.version,
+                "action": self.action,
+                "state": list(self.state),
+            }
+        return self._jsonable_dict
 
-    async def create_acl(self, i, sender_chan):
+    async def create_acl(self, i: int, out: List[Optional[ACL]], limiter: trio.CapacityLimiter):
         acl_name = f"crowdsec_{self.action}_{i}"
-        logger.info(with_suffix(f"creating acl {acl_name} ", service_id=self.service_id))
-        acl = await self.api.create_acl_for_service(
-            service_id=self.service_id, version=self.version, name=acl_name
-        )
-        logger.info(with_suffix(f"created acl {acl_name}", service_id=self.service_id))
-        async with sender_chan:
-            await sender_chan.send(acl)
+        async with limiter:
+            logger.info(with_suffix("creating acl %s ", acl_name, service_id=self.service_id))
+            out[i] = await self.api.create_acl_for_service(
+                service_id=self.service_id, version=self.version, name=acl_name
+            )
+        logger.info(with_suffix("created acl %s", acl_name, service_id=self.service_id))
 
-    async def create_acls(self, acl_count: int) -> None:
+    async def create_acls(self, acl_count: int) -> List[ACL]:
         """
         Provisions ACLs
         """
-        acls = []
-        sender, receiver = trio.open_memory_channel(0)
+        acls: List[Optional[ACL]] = [None] * acl_count
+        limiter = trio.CapacityLimiter(MAX_CONCURRENT_ACL_CREATIONS)
         async with trio.open_nursery() as n:
-            async with sender:
-                for i in range(acl_count):
-                    n.start_soon(self.create_acl, i, sender.clone())
-
-            async with receiver:
-                async for acl in receiver:
-                    acls.append(acl)
+            for i in range(acl_count):
+                n.start_soon(self.create_acl, i, acls, limiter)
         return acls
 
     def insert_item(self, item: str) -> bool:
         """
         Returns True if the item was successfully allocated in an ACL
         """
-        # Check if item is already present in some ACL
-        for acl in self.acls:
-            if not acl.is_full():
-                acl.entries_to_add.add(item)
-                acl.entry_count += 1
-                self.state.add(item)
-                return True
-        return False
+        nonfull_acls = self._nonfull_acls
+        while nonfull_acls and self.acls[nonfull_acls[0]].is_full():
+            heapq.heappop(nonfull_acls)
+        if not nonfull_acls:
+            return False
+
+        acl = self.acls[nonfull_acls[0]]
+        acl.entries_to_add.add(item)
+        acl.entry_count += 1
+        if acl.is_full():
+            heapq.heappop(nonfull_acls)
+        self.state.add(item)
+        self._entry_to_acl[item] = acl
+        self._dirty_acls[acl.name] = acl
+        self._jsonable_dict = None
+        return True
 
     def remove_item(self, item: str) -> bool:
         """
         Returns True if item is found, and removed.
         """
-        for acl in self.acls:
-            if item not in acl.entries:
-                continue
+        acl = self._entry_to_acl.pop(item, None)
+        if acl is None:
+            return False
+        # Items which never made it to fastly only need to be dropped from the pending additions.
+        acl.entries_to_add.discard(item)
+        if item in acl.entries:
             acl.entries_to_delete.add(item)
-            self.state.discard(item)
-            acl.entry_count -= 1
-            return True
-        return False
+        self.state.discard(item)
+        if acl.is_full():
+            heapq.heappush(self._nonfull_acls, self._position_by_acl_name[acl.name])
+        acl.entry_count -= 1
+        self._dirty_acls[acl.name] = acl
+        self._jsonable_dict = None
+        return True
 
     def transform_to_state(self, new_state):
+        if new_state == self.state:
+            return
+
         new_items = new_state - self.state
         expired_items = self.state - new_state
         if new_items:
             logger.info(
                 with_suffix(
-                    f"adding {len(new_items)} items to acl collection",
+                    "adding %d items to acl collection",
+                    len(new_items),
                     service_id=self.service_id,
                     action=self.action,
                 )
@@ -111,32 +162,34 @@ class ACLCollection:
         if expired_items:
             logger.info(
                 with_suffix(
-                    f"removing {len(expired_items)} items from acl collection",
+                    "removing %d items from acl collection",
+                    len(expired_items),
                     service_id=self.service_id,
                     action=self.action,
                 )
             )
 
-        for new_item in new_items:
-            if any([new_item in acl.entries for acl in self.acls]):
-                continue
-
+        # Items already present in some ACL are skipped, and only items held by some ACL can be
+        # removed. Both are resolved against the index with set operations.
+        for new_item in new_items.difference(self._entry_to_acl):
             if not self.insert_item(new_item):
                 logger.warn(
                     with_suffix(
-                        f"acl_collection for {self.action} is full. Ignoring remaining items.",
+                        "acl_collection for %s is full. Ignoring remaining items.",
+                        self.action,
                         service_id=self.service_id,
                     )
                 )
                 break
 
-        for expired_item in expired_items:
+        for expired_item in self._entry_to_acl.keys() & expired_items:
             self.remove_item(expired_item)
 
     async def commit(self) -> None:
-        acls_to_change = list(
-            filter(lambda acl: acl.entries_to_add or acl.entries_to_delete, self.acls)
-        )
+        acls_to_change = [
+            acl for acl in self._dirty_acls.values() if acl.entries_to_add or acl.entries_to_delete
+        ]
+        self._dirty_acls = {acl.name: acl for acl in acls_to_change}
 
         if len(acls_to_change):
             async with trio.open_nursery() as n:
@@ -144,22 +197,20 @@ class ACLCollection:
                     n.start_soon(self.update_acl, acl)
             logger.info(
                 with_suffix(
-                    f"acl collection for {self.action} updated",
+                    "acl collection for %s updated",
+                    self.action,
                     service_id=self.service_id,
                 )
             )
 
     def generate_conditions(self) -> str:
-        conditions = []
-        for acl in self.acls:
-            conditions.append(f"(client.ip ~ {acl.name})")
-
-        return " || ".join(conditions)
+        return " || ".join(f"(client.ip ~ {acl.name})" for acl in self.acls)
 
     async def update_acl(self, acl: ACL):
         logger.debug(
             with_suffix(
-                f"commiting changes to acl {acl.name}",
+                "commiting changes to acl %s",
+                acl.name,
                 service_id=self.service_id,
                 acl_collection=self.action,
             )
@@ -167,13 +218,16 @@ class ACLCollection:
         await self.api.process_acl(acl)
         logger.debug(
             with_suffix(
-                f"commited changes to acl {acl.name}",
+                "commited changes to acl %s",
+                acl.name,
                 service_id=self.service_id,
                 acl_collection=self.action,
             )
         )
-        acl.entries_to_add = set()
-        acl.entries_to_delete = set()
+        acl.entries_to_add.clear()
+        acl.entries_to_delete.clear()
+        self._dirty_acls.pop(acl.name, None)
+        self._jsonable_dict = None
 
 
 @dataclass
@@ -193,10 +247,27 @@ class Service:
     countries_by_action: Dict[str, Set[str]] = field(default_factory=dict)
     autonomoussystems_by_action: Dict[str, Set[str]] = field(default_factory=dict)
     acl_collection_by_action: Dict[str, ACLCollection] = field(default_factory=dict)
+    _conditional_cache: Dict[str, Tuple[Tuple, str]] = field(
+        default_factory=dict, init=False, repr=False, compare=False
+    )
+    _last_state: Optional[Dict[str, str]] = field(
+        default=None, init=False, repr=False, compare=False
+    )
 
     @classmethod
-    def from_jsonable_dict(cls, jsonable_dict: Dict):
-        api = FastlyAPI(jsonable_dict["token"])
+    def from_jsonable_dict(
+        cls, jsonable_dict: Dict, api_by_token: Optional[Dict[str, FastlyAPI]] = None
+    ):
+        """
+        "api_by_token" lets services of the same account share one FastlyAPI, and so one
+        connection pool, across calls.
+        """
+        if api_by_token is None:
+            api_by_token = {}
+        token = jsonable_dict["token"]
+        api = api_by_token.get(token)
+        if api is None:
+            api = api_by_token[token] = FastlyAPI(token)
         vcl_by_action = {
             action: VCL(**data) for action, data in jsonable_dict["vcl_by_action"].items()
         }
@@ -208,20 +279,7 @@ class Service:
                 version=jsonable_dict["version"],
                 action=action,
                 state=set(data["state"]),
-                acls=[
-                    ACL(
-                        id=acl_data["id"],
-                        name=acl_data["name"],
-                        service_id=acl_data["service_id"],
-                        version=acl_data["version"],
-                        entries_to_add=set(acl_data["entries_to_add"]),
-                        entries_to_delete=set(acl_data["entries_to_delete"]),
-                        entries=acl_data["entries"],
-                        entry_count=acl_data["entry_count"],
-                        created=acl_data["created"],
-                    )
-                    for acl_data in data["acls"]
-                ],
+                acls=[ACL.from_jsonable_dict(acl_data) for acl_data in data["acls"]],
             )
             for action, data in jsonable_dict["acl_collection_by_action"].items()
         }
@@ -268,7 +326,7 @@ class Service:
         autonomoussystems_by_action = {
             action: list(systems) for action, systems in self.autonomoussystems_by_action.items()
         }
-        static_vcls = list(map(lambda vcl: vcl.as_jsonable_dict(), self.static_vcls))
+        static_vcls = [vcl.as_jsonable_dict() for vcl in self.static_vcls]
 
         return {
             "token": self.api._token,
@@ -352,110 +410,147 @@ class Service:
             for vcl in self.static_vcls:
                 n.start_soon(self.api.create_vcl, vcl)
 
-    def clear_sets(self):
-        for action in self.supported_actions:
-            self.countries_by_action[action].clear()
-            self.autonomoussystems_by_action[action].clear()
-
     async def transform_state(self, new_state: Dict[str, str]):
         """
         This method transforms the configuration of the service according to the "new_state".
         "new_state" is mapping of item->action. Eg  {"1.2.3.4": "ban", "CN": "captcha", "1234": "ban"}.
         item is string representation of IP or Country or AS Number.
         """
-        new_acl_state_by_action = {action: set() for action in self.supported_actions}
-
-        prev_countries_by_action = {
-            action: countries.copy() for action, countries in self.countries_by_action.items()
-        }
-        prev_autonomoussystems_by_action = {
-            action: systems.copy() for action, systems in self.autonomoussystems_by_action.items()
-        }
-
-        self.clear_sets()
+        # Most polls bring no new decisions, those are skipped altogether.
+        if new_state == self._last_state:
+            return
 
+        items_by_action = {action: [] for action in self.supported_actions}
         for item, action in new_state.items():
-            if action not in self.supported_actions:
-                continue
-
-            # hacky check to see it's not IP
-            if "." not in item and ":" not in item:
-                # It's a AS number
-                if item.isnumeric():
-                    self.autonomoussystems_by_action[action].add(item)
-
-                # It's a country.
-                elif len(item) == 2:
-                    self.countries_by_action[action].add(item)
+            items = items_by_action.get(action)
+            if items is not None:
+                items.append(item)
+
+        # Items are classified in bulk per action. Anything containing "." or ":" is an IP or a
+        # range, the rest is either an AS number or a country code.
+        new_acl_state_by_action = {}
+        new_countries_by_action = {}
+        new_autonomoussystems_by_action = {}
+        for action, items in items_by_action.items():
+            non_ip_items = [item for item in items if "." not in item and ":" not in item]
+            new_acl_state = set(items)
+            new_acl_state.difference_update(non_ip_items)
+            new_acl_state_by_action[action] = new_acl_state
+            new_autonomoussystems_by_action[action] = {
+                item for item in non_ip_items if item.isnumeric()
+            }
+            new_countries_by_action[action] = {
+                item for item in non_ip_items if len(item) == 2 and not item.isnumeric()
+            }
 
-            # It's an IP
-            else:
-                new_acl_state_by_action[action].add(item)
+        # The previous sets are kept as they are for logging, the new ones take their place.
+        prev_countries_by_action = self.countries_by_action
+        prev_autonomoussystems_by_action = self.autonomoussystems_by_action
+        self.countries_by_action = new_countries_by_action
+        self.autonomoussystems_by_action = new_autonomoussystems_by_action
 
         for action, expected_acl_state in new_acl_state_by_action.items():
             self.acl_collection_by_action[action].transform_to_state(expected_acl_state)
 
-        for action in self.supported_actions:
-            expired_countries = prev_countries_by_action[action] - self.countries_by_action[action]
-            if expired_countries:
-                logger.info(f"{action} removed for countries {expired_countries} ")
-
-            expired_systems = (
-                prev_autonomoussystems_by_action[action] - self.autonomoussystems_by_action[action]
-            )
-            if expired_systems:
-                logger.info(f"{action} removed for AS {expired_systems} ")
-
-            new_countries = self.countries_by_action[action] - prev_countries_by_action[action]
-            if new_countries:
-                logger.info(f"countries {new_countries} will get {action} ")
-
-            new_systems = (
-                self.autonomoussystems_by_action[action] - prev_autonomoussystems_by_action[action]
-            )
-            if new_systems:
-                logger.info(f"AS {new_systems} will get {action}")
+        if logger.isEnabledFor(logging.INFO):
+            for action in self.supported_actions:
+                prev_countries = prev_countries_by_action[action]
+                countries = self.countries_by_action[action]
+                if prev_countries != countries:
+                    changed_countries = prev_countries ^ countries
+                    expired_countries = changed_countries & prev_countries
+                    if expired_countries:
+                        logger.info(f"{action} removed for countries {expired_countries} ")
+                    new_countries = changed_countries & countries
+                    if new_countries:
+                        logger.info(f"countries {new_countries} will get {action} ")
+
+                prev_systems = prev_autonomoussystems_by_action[action]
+                systems = self.autonomoussystems_by_action[action]
+                if prev_systems != systems:
+                    changed_systems = prev_systems ^ systems
+                    expired_systems = changed_systems & prev_systems
+                    if expired_systems:
+                        logger.info(f"{action} removed for AS {expired_systems} ")
+                    new_systems = changed_systems & systems
+                    if new_systems:
+                        logger.info(f"AS {new_systems} will get {action}")
 
         await self.commit()
+        # A full collection may have ignored some items, those are retried on the next poll even
+        # if the decisions are the same.
+        if all(
+            self.acl_collection_by_action[action].state == expected_acl_state
+            for action, expected_acl_state in new_acl_state_by_action.items()
+        ):
+            self._last_state = dict(new_state)
 
     async def commit(self):
         async with trio.open_nursery() as n:
             for action in self.vcl_by_action:
                 n.start_soon(self.acl_collection_by_action[action].commit)
-                n.start_soon(self.update_vcl, action)
+                conditional = self.generate_conditional_for_action(action)
+                if self.is_vcl_outdated(action, conditional):
+                    n.start_soon(self.update_vcl, action, conditional)
 
         if self._first_time and self.activate:
             logger.debug(
                 with_suffix(
-                    f"activating new service version {self.version}",
+                    "activating new service version %s",
+                    self.version,
                     service_id=self.service_id,
                 )
             )
             await self.api.activate_service_version(self.service_id, self.version)
             logger.info(
                 with_suffix(
-                    f"activated new service version {self.version}",
+                    "activated new service version %s",
+                    self.version,
                     service_id=self.service_id,
                 )
             )
             self._first_time = False
 
-    async def update_vcl(self, action: str):
+    def is_vcl_outdated(self, action: str, conditional: str) -> bool:
         vcl = self.vcl_by_action[action]
-        new_conditional = self.generate_conditional_for_action(action)
-        if new_conditional != vcl.conditional:
-            vcl.conditional = new_conditional
-            vcl = await self.api.create_or_update_vcl(vcl)
-            self.vcl_by_action[action] = vcl
+        # Matching hashes are confirmed with the full string, only a mismatch is conclusive.
+        return hash(conditional) != vcl.conditional_hash or conditional != vcl.conditional
+
+    async def update_vcl(self, action: str, conditional: str):
+        vcl = self.vcl_by_action[action]
+        vcl.conditional = conditional
+        vcl.conditional_hash = hash(conditional)
+        vcl = await self.api.create_or_update_vcl(vcl)
+        self.vcl_by_action[action] = vcl
 
     @staticmethod
     def generate_equalto_conditions_for_items(items: Iterable, equal_to: str, quote=False):
+        # Items are sorted to keep the generated VCL stable across calls. Every clause but the
+        # first is emitted by the separator, so the items are joined in a single pass.
         items = sorted(items)
+        if not items:
+            return ""
         if not quote:
-            return " || ".join([f"{equal_to} == {item}" for item in items])
-        return " || ".join([f'{equal_to} == "{item}"' for item in items])
+            return f"{equal_to} == " + f" || {equal_to} == ".join(items)
+        return f'{equal_to} == "' + f'" || {equal_to} == "'.join(items) + '"'
 
     def generate_conditional_for_action(self, action):
+        # The conditional only depends on these, so it is rebuilt only when one of them changes.
+        # Live sets are compared against the cached frozensets, so they are only copied on a miss.
+        countries = self.countries_by_action[action]
+        systems = self.autonomoussystems_by_action[action]
+        acl_names = tuple(acl.name for acl in self.acl_collection_by_action[action].acls)
+        cached = self._conditional_cache.get(action)
+        if cached is not None:
+            (cached_countries, cached_systems, cached_acl_names), conditional = cached
+            if (
+                cached_acl_names == acl_names
+                and cached_countries == countries
+                and cached_systems == systems
+            ):
+                return conditional
+        key = (frozenset(countries), frozenset(systems), acl_names)
+
         acl_conditions = self.acl_collection_by_action[action].generate_conditions()
         country_conditions = self.generate_equalto_conditions_for_items(
             self.countries_by_action[action], "client.geo.country_code", quote=True
@@ -464,11 +559,7 @@ class Service:
             self.autonomoussystems_by_action[action], "client.as.number"
         )
 
-        condition = " || ".join(
-            [
-                condition
-                for condition in [acl_conditions, country_conditions, as_conditions]
-                if condition
-            ]
-        )
-        return f"if ( {condition} )"
+        condition = " || ".join(filter(None, (acl_conditions, country_conditions, as_conditions)))
+        conditional = f"if ( {condition} )"
+        self._conditional_cache[action] = (key, conditional)
+        return conditional
@@ -1,6 +1,7 @@
 import logging
 import sys
 from importlib.metadata import version
+from typing import Dict, Tuple
 
 SUPPORTED_ACTIONS = ["ban", "captcha"]
 VERSION = version("crowdsec-fastly-bouncer")
@@ -20,10 +21,25 @@ class CustomFormatter(logging.Formatter):
         return formatter.format(record)
 
 
-def with_suffix(string: str, **kwargs):
-    keys = sorted(list(kwargs.keys()))
-    suffix = " ".join([f"{k}={kwargs[k]}" for k in keys])
-    return f"{string} {suffix}"
+class SuffixedMessage:
+    """
+    Log message made of a %-style format string and a sorted "key=value" suffix. It's only
+    rendered when the log record is emitted, so disabled levels don't pay for the formatting.
+    """
+
+    def __init__(self, string: str, args: Tuple, kwargs: Dict):
+        self.string = string
+        self.args = args
+        self.kwargs = kwargs
+
+    def __str__(self):
+        string = self.string % self.args if self.args else self.string
+        suffix = " ".join(f"{k}={self.kwargs[k]}" for k in sorted(self.kwargs))
+        return f"{string} {suffix}"
+
+
+def with_suffix(string: str, *args, **kwargs) -> SuffixedMessage:
+    return SuffixedMessage(string, args, kwargs)
 
 
 def are_filled_validator(**kwargs):
@@ -1,7 +1,9 @@
 from unittest import TestCase
-from unittest.mock import MagicMock
+from unittest.mock import AsyncMock, MagicMock
 
-from fastly_bouncer.fastly_api import ACL
+import trio
+
+from fastly_bouncer.fastly_api import ACL, ACL_CAPACITY
 from fastly_bouncer.service import ACLCollection
 
 
@@ -25,3 +27,83 @@ class TestACLCollection(TestCase):
         acl_collection.acls = [create_acl("acl_1")]
 
         assert acl_collection.generate_conditions() == "(client.ip ~ acl_1)"
+
+    def test_transform_to_state_uses_acl_entry_index(self):
+        acl_collection = ACLCollection(MagicMock(), "service_id", "3", "ban", state=set())
+        acl = create_acl("acl_1")
+        acl.entries = {"1.2.3.4/32": "entry_1"}
+        acl.entry_count = 1
+        acl_collection.acls = [acl, create_acl("acl_2")]
+
+        acl_collection.transform_to_state({"1.2.3.4/32", "5.6.7.8/32"})
+        assert acl_collection.acls[0].entries_to_add == {"5.6.7.8/32"}
+        assert acl_collection.acls[1].entries_to_add == set()
+
+        assert acl_collection.remove_item("1.2.3.4/32")
+        assert acl_collection.acls[0].entries_to_delete == {"1.2.3.4/32"}
+        assert acl_collection.remove_item("5.6.7.8/32")
+        assert acl_collection.acls[0].entries_to_add == set()
+        assert acl_collection.acls[0].entry_count == 0
+        assert not acl_collection.remove_item("5.6.7.8/32")
+
+    def test_insert_item_skips_full_acls(self):
+        acl_collection = ACLCollection(MagicMock(), "service_id", "3", "ban", state=set())
+        full_acl = create_acl("acl_1")
+        full_acl.entries = {"1.2.3.4/32": "entry_1"}
+        full_acl.entry_count = ACL_CAPACITY
+        acl_collection.acls = [full_acl, create_acl("acl_2")]
+
+        assert acl_collection.insert_item("5.6.7.8/32")
+        assert acl_collection.acls[1].entries_to_add == {"5.6.7.8/32"}
+
+        assert acl_collection.remove_item("1.2.3.4/32")
+        assert acl_collection.insert_item("9.9.9.9/32")
+        assert full_acl.entries_to_add == {"9.9.9.9/32"}
+
+        acl_collection.acls[1].entry_count = ACL_CAPACITY
+        assert not acl_collection.insert_item("10.0.0.1/32")
+
+    def test_jsonable_dict_is_reused_until_modified(self):
+        acl_collection = ACLCollection(MagicMock(), "service_id", "3", "ban", state=set())
+        acl_collection.acls = [create_acl("acl_1")]
+
+        jsonable_dict = acl_collection.as_jsonable_dict()
+        assert acl_collection.as_jsonable_dict() is jsonable_dict
+
+        acl_collection.insert_item("1.2.3.4/32")
+        jsonable_dict = acl_collection.as_jsonable_dict()
+        assert jsonable_dict["state"] == ["1.2.3.4/32"]
+        assert jsonable_dict["acls"][0]["entries_to_add"] == ["1.2.3.4/32"]
+
+    def test_default_state_is_not_shared(self):
+        first = ACLCollection(MagicMock(), "service_id", "3", "ban")
+        second = ACLCollection(MagicMock(), "service_id", "3", "ban")
+        first.acls = [create_acl("acl_1")]
+
+        assert first.insert_item("1.2.3.4/32")
+        assert second.state == set()
+        assert second.acls == []
+
+    def test_commit_only_processes_changed_acls(self):
+        api = MagicMock(process_acl=AsyncMock())
+        acl_collection = ACLCollection(api, "service_id", "3", "ban", state=set())
+        acl_collection.acls = [create_acl("acl_1"), create_acl("acl_2")]
+        acl_collection.insert_item("1.2.3.4/32")
+
+        trio.run(acl_collection.commit)
+        api.process_acl.assert_awaited_once_with(acl_collection.acls[0])
+        assert acl_collection.acls[0].entries_to_add == set()
+
+        trio.run(acl_collection.commit)
+        api.process_acl.assert_awaited_once()
+
+    def test_create_acls_keeps_acls_ordered(self):
+        async def create_acl_for_service(service_id, version, name):
+            await trio.sleep(0)
+            return create_acl(name)
+
+        api = MagicMock(create_acl_for_service=AsyncMock(side_effect=create_acl_for_service))
+        acl_collection = ACLCollection(api, "service_id", "3", "ban")
+
+        acls = trio.run(acl_collection.create_acls, 20)
+        assert [acl.name for acl in acls] == [f"crowdsec_ban_{i}" for i in range(20)]
@@ -0,0 +1,72 @@
+from unittest import TestCase
+
+import httpx
+import trio
+
+from fastly_bouncer.fastly_api import ACL, FastlyAPI, ThrottledAsyncClient
+
+
+class TestThrottledAsyncClient(TestCase):
+    def test_concurrent_requests_are_capped(self):
+        in_flight = 0
+        max_in_flight = 0
+
+        async def handler(request):
+            nonlocal in_flight, max_in_flight
+            in_flight += 1
+            max_in_flight = max(max_in_flight, in_flight)
+            await trio.sleep(0.01)
+            in_flight -= 1
+            return httpx.Response(200, json={})
+
+        async def send_requests():
+            client = ThrottledAsyncClient(
+                max_concurrent_requests=3, transport=httpx.MockTransport(handler)
+            )
+            async with trio.open_nursery() as n:
+                for _ in range(10):
+                    n.start_soon(client.get, "https://api.fastly.com/service")
+
+        trio.run(send_requests)
+        assert max_in_flight == 3
+
+
+class TestProcessACL(TestCase):
+    def process_acl(self, acl, remote_entries):
+        requests = []
+
+        async def handler(request):
+            requests.append(request)
+            if request.method == "GET":
+                return httpx.Response(200, json=remote_entries)
+            return httpx.Response(200, json={"status": "ok"})
+
+        api = FastlyAPI("token")
+        api.session = ThrottledAsyncClient(
+            max_concurrent_requests=3, transport=httpx.MockTransport(handler)
+        )
+        trio.run(api.process_acl, acl)
+        return requests
+
+    def test_changes_are_sent_in_one_batch(self):
+        acl = ACL(id="acl_id", name="acl", service_id="sid", version="1")
+        acl.entries = {"1.2.3.4/32": "entry_1"}
+        acl.entries_to_add = {"5.6.7.8/32", "2001:db8::/64"}
+        acl.entries_to_delete = {"1.2.3.4/32"}
+        remote_entries = [
+            {"ip": "5.6.7.8", "subnet": 32, "id": "entry_2"},
+            {"ip": "2001:0db8::", "subnet": 64, "id": "entry_3"},
+        ]
+
+        requests = self.process_acl(acl, remote_entries)
+        assert [request.method for request in requests] == ["PATCH", "GET"]
+        assert acl.entries == {"5.6.7.8/32": "entry_2", "2001:db8::/64": "entry_3"}
+
+    def test_deletions_do_not_refresh_entries(self):
+        acl = ACL(id="acl_id", name="acl", service_id="sid", version="1")
+        acl.entries = {"1.2.3.4/32": "entry_1", "5.6.7.8/32": "entry_2"}
+        acl.entries_to_delete = {"1.2.3.4/32"}
+
+        requests = self.process_acl(acl, [])
+        assert [request.method for request in requests] == ["PATCH"]
+        assert acl.entries == {"5.6.7.8/32": "entry_2"}
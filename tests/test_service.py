@@ -0,0 +1,139 @@
+from unittest import TestCase
+from unittest.mock import AsyncMock, MagicMock, patch
+
+import trio
+
+from fastly_bouncer.fastly_api import ACL
+from fastly_bouncer.service import ACLCollection, Service
+
+
+def create_service():
+    api = MagicMock(_token="token")
+    acl_collection_by_action = {}
+    for action in ["ban", "captcha"]:
+        acl_collection = ACLCollection(api, "service_id", "3", action, state=set())
+        acl_collection.acls = [
+            ACL(id="1", name=f"crowdsec_{action}_0", service_id="service_id", version="3")
+        ]
+        acl_collection_by_action[action] = acl_collection
+
+    return Service(
+        api=api,
+        version="3",
+        service_id="service_id",
+        recaptcha_site_key="site_key",
+        recaptcha_secret="secret",
+        activate=False,
+        acl_collection_by_action=acl_collection_by_action,
+    )
+
+
+class TestService(TestCase):
+    def test_conditional_for_action(self):
+        service = create_service()
+        service.countries_by_action["ban"] = {"FR", "CN"}
+        service.autonomoussystems_by_action["ban"] = {"1234"}
+
+        conditional = service.generate_conditional_for_action("ban")
+        assert conditional == (
+            "if ( (client.ip ~ crowdsec_ban_0) || client.geo.country_code == "
+            '"CN" || client.geo.country_code == "FR" || client.as.number == 1234 )'
+        )
+        assert service.generate_conditional_for_action("ban") is conditional
+
+        service.countries_by_action["ban"].discard("CN")
+        assert service.generate_conditional_for_action("ban") == (
+            'if ( (client.ip ~ crowdsec_ban_0) || client.geo.country_code == "FR" || '
+            "client.as.number == 1234 )"
+        )
+
+    def test_transform_state_classifies_items(self):
+        service = create_service()
+        service.commit = AsyncMock()
+        new_state = {
+            "1.2.3.4/32": "ban",
+            "2001:db8::/64": "captcha",
+            "CN": "captcha",
+            "1234": "ban",
+            "12": "ban",
+            "unknown": "ban",
+            "5.6.7.8/32": "throttle",
+        }
+        trio.run(service.transform_state, new_state)
+
+        assert service.acl_collection_by_action["ban"].state == {"1.2.3.4/32"}
+        assert service.acl_collection_by_action["captcha"].state == {"2001:db8::/64"}
+        assert service.countries_by_action == {"ban": set(), "captcha": {"CN"}}
+        assert service.autonomoussystems_by_action == {"ban": {"1234", "12"}, "captcha": set()}
+        service.commit.assert_awaited_once()
+
+        trio.run(service.transform_state, dict(new_state))
+        service.commit.assert_awaited_once()
+
+    def test_transform_state_retries_items_ignored_by_a_full_collection(self):
+        service = create_service()
+        service.commit = AsyncMock()
+        acl_collection = service.acl_collection_by_action["ban"]
+        old_state = {"1.1.1.1/32": "ban", "2.2.2.2/32": "ban"}
+        new_state = {"3.3.3.3/32": "ban", "4.4.4.4/32": "ban"}
+
+        with patch("fastly_bouncer.fastly_api.ACL_CAPACITY", 2):
+            trio.run(service.transform_state, old_state)
+            assert acl_collection.state == set(old_state)
+
+            # The new items are rejected while the old ones still fill the ACL.
+            trio.run(service.transform_state, new_state)
+            assert acl_collection.state == set()
+
+            trio.run(service.transform_state, dict(new_state))
+            assert acl_collection.state == set(new_state)
+            assert service.commit.await_count == 3
+
+            trio.run(service.transform_state, dict(new_state))
+            assert service.commit.await_count == 3
+
+    def test_jsonable_dict_round_trip(self):
+        service = create_service()
+        acl_collection = service.acl_collection_by_action["ban"]
+        acl_collection.acls[0].entries = {"1.2.3.4/32": "entry_1"}
+        acl_collection.acls[0].entry_count = 2
+        acl_collection.acls = acl_collection.acls
+        acl_collection.transform_to_state({"1.2.3.4/32", "5.6.7.8/32"})
+
+        jsonable_dict = service.as_jsonable_dict()
+        restored = Service.from_jsonable_dict(jsonable_dict)
+        assert restored.as_jsonable_dict() == jsonable_dict
+        restored_acl = restored.acl_collection_by_action["ban"].acls[0]
+        assert restored_acl.entries_to_add == {"5.6.7.8/32"}
+        assert restored_acl.entries == {"1.2.3.4/32": "entry_1"}
+
+    def test_commit_skips_unchanged_conditionals(self):
+        service = create_service()
+        service.api.create_or_update_vcl = AsyncMock(side_effect=lambda vcl: vcl)
+        service.generate_conditional_for_action = MagicMock(
+            wraps=service.generate_conditional_for_action
+        )
+
+        trio.run(service.commit)
+        assert service.api.create_or_update_vcl.await_count == 2
+        assert service.generate_conditional_for_action.call_count == 2
+
+        trio.run(service.commit)
+        assert service.api.create_or_update_vcl.await_count == 2
+
+        service.countries_by_action["ban"].add("FR")
+        trio.run(service.commit)
+        assert service.api.create_or_update_vcl.await_count == 3
+        assert service.vcl_by_action["ban"].conditional.endswith(
+            'client.geo.country_code == "FR" )'
+        )
+
+    def test_services_restored_with_the_same_token_share_the_api(self):
+        jsonable_dict = create_service().as_jsonable_dict()
+        api_by_token = {}
+        first = Service.from_jsonable_dict(jsonable_dict, api_by_token)
+        second = Service.from_jsonable_dict(jsonable_dict, api_by_token)
+
+        assert first.api is second.api
+        assert first.acl_collection_by_action["ban"].api is first.api
+        assert api_by_token == {"token": first.api}
@@ -0,0 +1,16 @@
+from unittest import TestCase
+
+from fastly_bouncer.utils import with_suffix
+
+
+class TestWithSuffix(TestCase):
+    def test_suffix_is_sorted(self):
+        assert str(with_suffix("created acl", service_id="a", action="ban")) == (
+            "created acl action=ban service_id=a"
+        )
+
+    def test_format_args_are_applied_lazily(self):
+        items = {"1.2.3.4/32"}
+        message = with_suffix("entries to add %s", items, acl_id="1")
+        items.add("5.6.7.8/32")
+        assert str(message) == f"entries to add {items} acl_id=1"